@@ -1,8 +1,7 @@
 import socket
-import select
+import itertools
 import struct
 import time
-import signal
 import re
 import sqlite3
 import time
@@ -13,10 +12,6 @@ class MCRconException(Exception):
     pass
 
 
-def timeout_handler(signum, frame):
-    raise MCRconException("Connection timeout error")
-
-
 class MCRcon(object):
     socket = None
 
@@ -25,7 +20,6 @@ class MCRcon(object):
         self.password = password
         self.port = port
         self.timeout = timeout
-        signal.signal(signal.SIGALRM, timeout_handler)
 
     def __enter__(self):
         self.connect()
@@ -36,7 +30,15 @@ class MCRcon(object):
 
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        self.socket.settimeout(self.timeout)
+        # Send each packet as soon as it is written instead of waiting to
+        # coalesce it with the next one
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.socket.connect((self.host, self.port))
+        except socket.timeout:
+            raise MCRconException("Connection timeout error")
+        self.request_ids = itertools.count(1)
         self._send(3, self.password)
 
     def disconnect(self):
@@ -45,51 +47,75 @@ class MCRcon(object):
             self.socket = None
 
     def _read(self, length):
-        signal.alarm(self.timeout)
-        data = b""
-        while len(data) < length:
-            data += self.socket.recv(length - len(data))
-        signal.alarm(0)
-        return data
-
-    def _send(self, out_type, out_data):
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            try:
+                chunk_length = self.socket.recv_into(view[received:])
+            except socket.timeout:
+                raise MCRconException("Connection timeout error")
+            if chunk_length == 0:
+                raise MCRconException("Connection closed by server")
+            received += chunk_length
+        return bytes(data)
+
+    def _send_packet(self, out_id, out_type, out_data):
         if self.socket is None:
             raise MCRconException("Must connect before sending data")
 
-        # Send a request packet
         out_payload = (
-            struct.pack("<ii", 0, out_type) +
+            struct.pack("<ii", out_id, out_type) +
             out_data.encode("utf8") + b"\x00\x00"
         )
         out_length = struct.pack("<i", len(out_payload))
-        self.socket.send(out_length + out_payload)
+        try:
+            self.socket.sendall(out_length + out_payload)
+        except socket.timeout:
+            raise MCRconException("Connection timeout error")
+        time.sleep(0.003)  # MC-72390 workaround
+
+    def _read_packet(self):
+        (in_length,) = struct.unpack("<i", self._read(4))
+        in_payload = self._read(in_length)
+        in_id, in_type = struct.unpack("<ii", in_payload[:8])
+        in_data_partial, in_padding = in_payload[8:-2], in_payload[-2:]
+
+        # Sanity checks
+        if in_padding != b"\x00\x00":
+            raise MCRconException("Incorrect padding")
+        if in_id == -1:
+            raise MCRconException("Login failed")
+
+        return in_id, in_data_partial.decode("utf8")
+
+    def _send(self, out_type, out_data):
+        out_id = next(self.request_ids)
+        self._send_packet(out_id, out_type, out_data)
+
+        # Follow up with a packet type the server doesn't handle. The server
+        # answers packets in order and echoes the id of the unknown one back,
+        # so its reply marks the end of the response to the first packet.
+        # Vanilla drops the connection if a single read holds more than one
+        # packet (MC-72390). While the command runs only the marker can queue
+        # up behind it, so never send another request before this one returns.
+        end_id = next(self.request_ids)
+        self._send_packet(end_id, 0, "")
 
         # Read response packets
         in_data = ""
         while True:
-            # Read a packet
-            (in_length,) = struct.unpack("<i", self._read(4))
-            in_payload = self._read(in_length)
-            in_id, in_type = struct.unpack("<ii", in_payload[:8])
-            in_data_partial, in_padding = in_payload[8:-2], in_payload[-2:]
-
-            # Sanity checks
-            if in_padding != b"\x00\x00":
-                raise MCRconException("Incorrect padding")
-            if in_id == -1:
-                raise MCRconException("Login failed")
+            in_id, in_data_partial = self._read_packet()
+            if in_id == end_id:
+                return in_data
+            if in_id != out_id:
+                raise MCRconException(f"Unexpected response id {in_id}")
 
             # Record the response
-            in_data += in_data_partial.decode("utf8")
-
-            # If there's nothing more to receive, return the response
-            if len(select.select([self.socket], [], [], 0)[0]) == 0:
-                return in_data
+            in_data += in_data_partial
 
     def command(self, command):
-        result = self._send(2, command)
-        time.sleep(0.003)  # MC-72390 workaround
-        return result
+        return self._send(2, command)
 
 
 def init_sqlite(db):
@@ -131,8 +157,11 @@ def insert_stats(db, timestamp, players, mspt):
     db.commit()
 
 
+COLOR_CODE_PATTERN = re.compile("\xa7[0-9a-f]", flags=re.IGNORECASE)
+
+
 def strip_color_codes(text):
-    return re.sub("\xa7[0-9a-f]", "", text, flags=re.IGNORECASE)
+    return COLOR_CODE_PATTERN.sub("", text)
 
 
 def mspt(rcon):
@@ -151,11 +180,14 @@ def mspt(rcon):
     }
 
 
+PLAYERS_ONLINE_PATTERN = re.compile(
+    r"There are (\d+) of a max of (\d+) players online: (.*)")
+
+
 def players_online(rcon):
     response = rcon.command("list")
 
-    match = re.match(
-        r"There are (\d+) of a max of (\d+) players online: (.*)", response)
+    match = PLAYERS_ONLINE_PATTERN.match(response)
     if match is None:
         print("Unexpected response from server:", response)
         return
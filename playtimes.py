@@ -1,64 +1,271 @@
 import os
-import gzip
-import re
+import sys
+import json
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-def log_file_lines(directory):
+try:
+    # RE2 matches in linear time with a DFA and supports the same API for our pattern
+    import re2 as re
+except ImportError:
+    import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    # ISA-L's inflate is a drop-in replacement for zlib's and much faster
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Logs are scanned in large chunks so the regex engine, not Python, does the
+# per-line work
+CHUNK_SIZE = 1024 * 1024
+
+def log_files(directory):
     sorted_files = sorted(os.listdir(directory))
     for filename in sorted_files:
         if filename == 'latest.log':
             date_str = datetime.now().strftime('%Y-%m-%d')
-            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
-                for line in f.readlines():
-                    yield date_str, line
+            yield date_str, os.path.join(directory, filename)
         elif filename.endswith('.log.gz'):
             date_str = filename.split('-')[0:3]
             date_str = '-'.join(date_str)
-            with gzip.open(os.path.join(directory, filename), 'rt', encoding='utf-8') as f:
-                for line in f.readlines():
-                    yield date_str, line
+            path = os.path.join(directory, filename)
+
+            # Prefer the copy made by recompress_logs.py, which is much cheaper
+            # to decompress
+            zstd_path = path[:-len('.gz')] + '.zst'
+            if zstandard is not None and os.path.exists(zstd_path):
+                path = zstd_path
+
+            yield date_str, path
+
+def log_file_chunks(date_str, path):
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    elif path.endswith('.zst'):
+        f = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    else:
+        f = open(path, 'rb')
 
-JOIN_LEAVE_PATTERN = re.compile(r'\[(\d{2}:\d{2}:\d{2})\] \[Server thread/INFO\]: (.+) (joined|left) the game')
+    # Every chunk starts with a newline and ends on a line boundary, so each
+    # line can be matched from the newline in front of it
+    with f:
+        remainder = b'\n'
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
 
-def extract_events_from_logs(lines):    
-    for date_str, line in lines:
-        join_leave_match = JOIN_LEAVE_PATTERN.search(line)
-        if not join_leave_match:
-            continue
+            chunk = remainder + data
+            end = chunk.rfind(b'\n')
+            if end > 0:
+                yield date_str, chunk[:end]
+            remainder = chunk[end:]
 
-        time_str = join_leave_match.group(1)
-        player = join_leave_match.group(2)
-        action = join_leave_match.group(3)
+        if len(remainder) > 1:
+            yield date_str, remainder
 
-        event_time = datetime.strptime(f"{date_str} {time_str}", '%Y-%m-%d %H:%M:%S')
+JOIN_LEAVE_PATTERN = re.compile(rb'\n\[(\d{2}:\d{2}:\d{2})\] \[Server thread/INFO\]: (.+) (joined|left) the game')
 
-        yield event_time, player, action
+# Log dates are always YYYY-MM-DD, so fixed slices are much cheaper than strptime
+@lru_cache(maxsize=None)
+def parse_log_date(date_str):
+    return int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10])
+
+def extract_events_from_logs(chunks):
+    for date_str, chunk in chunks:
+        log_date = parse_log_date(date_str)
+
+        for join_leave_match in JOIN_LEAVE_PATTERN.finditer(chunk):
+            time_str = join_leave_match.group(1)
+            player = sys.intern(join_leave_match.group(2).decode('utf-8'))
+            action = join_leave_match.group(3).decode('ascii')
+
+            # Every line in a file shares a date, so only the time needs parsing per event
+            event_time = datetime(
+                *log_date,
+                int(time_str[0:2]),
+                int(time_str[3:5]),
+                int(time_str[6:8]))
+
+            yield event_time, player, action
 
 def calculate_play_time(events):
-    play_time = defaultdict(timedelta)
-    active_sessions = {}
+    if np is not None:
+        return calculate_play_time_numpy(events)
+
+    # Players are numbered in order of appearance so per-event state lives in
+    # lists instead of being looked up by name in several dicts
+    player_ids = {}
+    join_times = []
+    play_time = []
     
     for event_time, player, action in events:
+        player_id = player_ids.setdefault(player, len(player_ids))
+        if player_id == len(play_time):
+            join_times.append(None)
+            play_time.append(None)
+
+        join_time = join_times[player_id]
         if action == 'joined':
-            active_sessions[player] = event_time
-        elif action == 'left' and player in active_sessions:
-            join_time = active_sessions.pop(player)
+            join_times[player_id] = event_time
+        elif action == 'left' and join_time is not None:
+            join_times[player_id] = None
             delta = event_time - join_time
-            play_time[player] += delta
+            total = play_time[player_id]
+            play_time[player_id] = delta if total is None else total + delta
     
+    return {
+        player: play_time[player_id]
+        for player, player_id in player_ids.items()
+        if play_time[player_id] is not None
+    }
+
+def calculate_play_time_numpy(events):
+    events = list(events)
+    if not events:
+        return {}
+
+    event_times, players, actions = zip(*events)
+    times = np.array(event_times, dtype='datetime64[s]')
+    names, codes = np.unique(np.array(players, dtype=object), return_inverse=True)
+    joined = np.array(actions, dtype=object) == 'joined'
+
+    # A stable sort by player keeps each player's events in log order. A leave
+    # closes a session exactly when that player's previous event was a join.
+    order = np.argsort(codes, kind='stable')
+    times, codes, joined = times[order], codes[order], joined[order]
+    closes = (codes[1:] == codes[:-1]) & joined[:-1] & ~joined[1:]
+
+    session_codes = codes[1:][closes]
+    durations = (times[1:] - times[:-1])[closes].astype('int64')
+    totals = np.bincount(session_codes, weights=durations, minlength=len(names))
+    sessions = np.bincount(session_codes, minlength=len(names))
+
+    return {
+        names[code]: timedelta(seconds=int(totals[code]))
+        for code in np.flatnonzero(sessions)
+    }
+
+# Rotated logs never change, so their summaries are kept between runs
+CACHE_FILENAME = '.playtime_cache.json'
+# Bump whenever event extraction or session pairing changes, so summaries
+# computed by older code are thrown away
+CACHE_VERSION = 1
+
+def summarize_log_file(date_str, path):
+    events = list(extract_events_from_logs(log_file_chunks(date_str, path)))
+
+    # Sessions can span log files, so also record how this file's events pair
+    # up with its neighbours: what each player did first and whether they
+    # were still online at the end of the file
+    first_leaves = {}
+    open_joins = {}
+    players = set()
+    for event_time, player, action in events:
+        if action == 'left' and player not in players:
+            first_leaves[player] = event_time.isoformat()
+        players.add(player)
+
+        if action == 'joined':
+            open_joins[player] = event_time.isoformat()
+        else:
+            open_joins.pop(player, None)
+
+    return {
+        'play_time': {
+            player: int(time.total_seconds())
+            for player, time in calculate_play_time(events).items()
+        },
+        'first_leaves': first_leaves,
+        'open_joins': open_joins,
+        'players': sorted(players),
+    }
+
+def cached_log_file_summary(cache, date_str, path):
+    filename = os.path.basename(path)
+    mtime = os.path.getmtime(path)
+
+    entry = cache.get(filename)
+    if entry is None or entry['mtime'] != mtime:
+        entry = {'mtime': mtime, 'summary': summarize_log_file(date_str, path)}
+
+    return filename, entry
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return {}
+
+    return cache['files']
+
+def save_cache(cache_path, cache):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': CACHE_VERSION, 'files': cache}, f)
+    os.replace(tmp_path, cache_path)
+
+def log_summaries(directory):
+    cache_path = os.path.join(directory, CACHE_FILENAME)
+    cache = load_cache(cache_path)
+
+    # Each log file is decompressed and scanned on its own thread, but the
+    # results are kept in file order so sessions still pair up correctly
+    with ThreadPoolExecutor() as executor:
+        entries = list(executor.map(
+            lambda args: cached_log_file_summary(cache, *args),
+            log_files(directory)))
+
+    # latest.log is still being written to. Saving only the current files
+    # also drops logs that have since been deleted.
+    save_cache(cache_path, {
+        filename: entry
+        for filename, entry in entries
+        if filename != 'latest.log'
+    })
+
+    return [entry['summary'] for _, entry in entries]
+
+def combine_summaries(summaries):
+    play_time = defaultdict(timedelta)
+    active_sessions = {}
+
+    for summary in summaries:
+        for player, seconds in summary['play_time'].items():
+            play_time[player] += timedelta(seconds=seconds)
+
+        # Close sessions that were still open at the end of an earlier file
+        for player, leave_time in summary['first_leaves'].items():
+            if player in active_sessions:
+                join_time = active_sessions[player]
+                play_time[player] += datetime.fromisoformat(leave_time) - join_time
+
+        # Anyone with events in this file has had their session state replaced
+        for player in summary['players']:
+            active_sessions.pop(player, None)
+        for player, join_time in summary['open_joins'].items():
+            active_sessions[player] = datetime.fromisoformat(join_time)
+
     return play_time
 
-def main():
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    lines = log_file_lines(os.path.join(base_dir, 'logs'))
-    events = extract_events_from_logs(lines)
-    play_time = calculate_play_time(events)
-    
-    sorted_play_time = sorted(play_time.items(), key=lambda x: x[1], reverse=True)
-    
-    with open(os.path.join(base_dir, 'plugins/dynmap/web/playtimes.html'), 'w') as f:
-        print("""
+HTML_HEADER = """
             <!doctype html>
             <html>
                 <head>
@@ -112,21 +319,38 @@ def main():
                                 <th>Playtime (Last 30 Days)</th>
                             </tr>
                         </thead>
-                        <tbody>""", file=f)
-        for player, time in sorted_play_time:
-            print(f"""
+                        <tbody>
+"""
+
+HTML_ROW = """
                             <tr>
                                 <td>{player}</td>
                                 <td><span class="duration">{time}</span></td>
-                            </tr>""", file=f)
-        print(f"""
+                            </tr>
+"""
+
+HTML_FOOTER = """
                         </tbody>
                     </table>
                     <div class="footer">
-                        Last updated: {datetime.now().strftime('%Y/%m/%d %H:%M:%S EST')}
+                        Last updated: {updated}
                     </div>
                 </body>
-            </html>""", file=f)
+            </html>
+"""
+
+def main():
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    summaries = log_summaries(os.path.join(base_dir, 'logs'))
+    play_time = combine_summaries(summaries)
+    
+    sorted_play_time = sorted(play_time.items(), key=lambda x: x[1], reverse=True)
+    
+    rows = ''.join(HTML_ROW.format(player=player, time=time) for player, time in sorted_play_time)
+    footer = HTML_FOOTER.format(updated=datetime.now().strftime('%Y/%m/%d %H:%M:%S EST'))
+
+    with open(os.path.join(base_dir, 'plugins/dynmap/web/playtimes.html'), 'w') as f:
+        f.write(HTML_HEADER + rows + footer)
 
 if __name__ == '__main__':
     main()
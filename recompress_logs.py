@@ -0,0 +1,42 @@
+import gzip
+import os
+
+import zstandard
+
+
+# Rotated logs never change once written, so they only need recompressing once
+ZSTD_LEVEL = 19
+CHUNK_SIZE = 1024 * 1024
+
+
+def recompress(gz_path, zstd_path):
+    tmp_path = zstd_path + ".tmp"
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+    with gzip.open(gz_path, "rb") as src, open(tmp_path, "wb") as dst:
+        compressor.copy_stream(src, dst, read_size=CHUNK_SIZE, write_size=CHUNK_SIZE)
+
+    # Only expose the file once it is complete so readers never see a partial log
+    os.replace(tmp_path, zstd_path)
+
+
+def main():
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    log_dir = os.path.join(base_dir, "logs")
+
+    for filename in sorted(os.listdir(log_dir)):
+        path = os.path.join(log_dir, filename)
+
+        if filename.endswith(".log.gz"):
+            zstd_path = path[:-len(".gz")] + ".zst"
+            if not os.path.exists(zstd_path):
+                print(f"Recompressing {filename}")
+                recompress(path, zstd_path)
+        elif filename.endswith(".log.zst"):
+            # The original was removed by log rotation, so drop the copy too
+            if not os.path.exists(path[:-len(".zst")] + ".gz"):
+                print(f"Removing {filename}")
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,26 @@
 import socket
-import select
+import itertools
 import struct
 import time
-import signal
 import random
 import re
 import http.client
 import json
 import os
+import hashlib
 import textwrap
 import traceback
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class MCRconException(Exception):
     pass
 
 
-def timeout_handler(signum, frame):
-    raise MCRconException("Connection timeout error")
-
-
 class MCRcon(object):
     socket = None
 
@@ -28,7 +29,6 @@ class MCRcon(object):
         self.password = password
         self.port = port
         self.timeout = timeout
-        signal.signal(signal.SIGALRM, timeout_handler)
 
     def __enter__(self):
         self.connect()
@@ -39,7 +39,15 @@ class MCRcon(object):
 
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        self.socket.settimeout(self.timeout)
+        # Send each packet as soon as it is written instead of waiting to
+        # coalesce it with the next one
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.socket.connect((self.host, self.port))
+        except socket.timeout:
+            raise MCRconException("Connection timeout error")
+        self.request_ids = itertools.count(1)
         self._send(3, self.password)
 
     def disconnect(self):
@@ -48,51 +56,75 @@ class MCRcon(object):
             self.socket = None
 
     def _read(self, length):
-        signal.alarm(self.timeout)
-        data = b""
-        while len(data) < length:
-            data += self.socket.recv(length - len(data))
-        signal.alarm(0)
-        return data
-
-    def _send(self, out_type, out_data):
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            try:
+                chunk_length = self.socket.recv_into(view[received:])
+            except socket.timeout:
+                raise MCRconException("Connection timeout error")
+            if chunk_length == 0:
+                raise MCRconException("Connection closed by server")
+            received += chunk_length
+        return bytes(data)
+
+    def _send_packet(self, out_id, out_type, out_data):
         if self.socket is None:
             raise MCRconException("Must connect before sending data")
 
-        # Send a request packet
         out_payload = (
-            struct.pack("<ii", 0, out_type) +
+            struct.pack("<ii", out_id, out_type) +
             out_data.encode("utf8") + b"\x00\x00"
         )
         out_length = struct.pack("<i", len(out_payload))
-        self.socket.send(out_length + out_payload)
+        try:
+            self.socket.sendall(out_length + out_payload)
+        except socket.timeout:
+            raise MCRconException("Connection timeout error")
+        time.sleep(0.003)  # MC-72390 workaround
+
+    def _read_packet(self):
+        (in_length,) = struct.unpack("<i", self._read(4))
+        in_payload = self._read(in_length)
+        in_id, in_type = struct.unpack("<ii", in_payload[:8])
+        in_data_partial, in_padding = in_payload[8:-2], in_payload[-2:]
+
+        # Sanity checks
+        if in_padding != b"\x00\x00":
+            raise MCRconException("Incorrect padding")
+        if in_id == -1:
+            raise MCRconException("Login failed")
+
+        return in_id, in_data_partial.decode("utf8")
+
+    def _send(self, out_type, out_data):
+        out_id = next(self.request_ids)
+        self._send_packet(out_id, out_type, out_data)
+
+        # Follow up with a packet type the server doesn't handle. The server
+        # answers packets in order and echoes the id of the unknown one back,
+        # so its reply marks the end of the response to the first packet.
+        # Vanilla drops the connection if a single read holds more than one
+        # packet (MC-72390). While the command runs only the marker can queue
+        # up behind it, so never send another request before this one returns.
+        end_id = next(self.request_ids)
+        self._send_packet(end_id, 0, "")
 
         # Read response packets
         in_data = ""
         while True:
-            # Read a packet
-            (in_length,) = struct.unpack("<i", self._read(4))
-            in_payload = self._read(in_length)
-            in_id, in_type = struct.unpack("<ii", in_payload[:8])
-            in_data_partial, in_padding = in_payload[8:-2], in_payload[-2:]
-
-            # Sanity checks
-            if in_padding != b"\x00\x00":
-                raise MCRconException("Incorrect padding")
-            if in_id == -1:
-                raise MCRconException("Login failed")
+            in_id, in_data_partial = self._read_packet()
+            if in_id == end_id:
+                return in_data
+            if in_id != out_id:
+                raise MCRconException(f"Unexpected response id {in_id}")
 
             # Record the response
-            in_data += in_data_partial.decode("utf8")
-
-            # If there's nothing more to receive, return the response
-            if len(select.select([self.socket], [], [], 0)[0]) == 0:
-                return in_data
+            in_data += in_data_partial
 
     def command(self, command):
-        result = self._send(2, command)
-        time.sleep(0.003)  # MC-72390 workaround
-        return result
+        return self._send(2, command)
 
 
 MINECRAFT_BIOMES = [
@@ -197,20 +229,131 @@ def test_for_block(rcon, x, y, z, block):
         raise Exception("Unexpected output from execute command: " + output)
 
 
+BLOCK_COUNT_PATTERN = re.compile(r"Test passed, count: (\d+)")
+
+
+# Comparing a column with itself always passes, and in masked mode the reported
+# count is the number of blocks in it that aren't minecraft:air
+def count_non_air_blocks(rcon, x, y1, y2, z):
+    output = rcon.command(
+        f"execute if blocks {x} {y1} {z} {x} {y2} {z} {x} {y1} {z} masked")
+
+    match = BLOCK_COUNT_PATTERN.fullmatch(output)
+    if match:
+        return int(match.group(1))
+    elif output == "That position is not loaded":
+        raise PositionNotLoaded()
+    else:
+        raise Exception("Unexpected output from execute command: " + output)
+
+
+BIOME_TAG_PATTERN = re.compile(r"\(minecraft:(\w+)\) is at .* \((\d+) blocks away\)")
+BIOME_DISTANCE_PATTERN = re.compile(r"\((\d+) blocks away\)")
+BIOME_NOT_FOUND_PATTERN = re.compile(r"Could not find a biome of type .* within reasonable distance")
+
+
+def locate_biome_command(x, y, z, biome):
+    return f"execute positioned {x} {y} {z} run locate biome {biome}"
+
+
 def detect_biome(rcon, x, y, z):
-    for biome in MINECRAFT_BIOMES:
-        time.sleep(1)  # Delay to keep from hammering the Minecraft main thread
-        output = rcon.command(
-            f"execute positioned {x} {y} {z} run locate biome minecraft:{biome}")
+    # One tag lookup rules every ocean biome in or out, and names the
+    # specific ocean biome it found
+    start = time.monotonic()
+    output = rcon.command(locate_biome_command(x, y, z, "#minecraft:is_ocean"))
+    command_duration = time.monotonic() - start
+
+    land_biomes = [biome for biome in MINECRAFT_BIOMES if "ocean" not in biome]
+    match = BIOME_TAG_PATTERN.search(output)
+    if match is not None and int(match.group(2)) == 0:
+        return match.group(1)
+    elif match is not None or BIOME_NOT_FOUND_PATTERN.search(output):
+        # The nearest ocean is somewhere else, or there is none nearby at all
+        candidates = land_biomes
+    else:
+        print(f"Error: Could not parse output - {output}")
+        candidates = MINECRAFT_BIOMES
+
+    for biome in candidates:
+        # Back off for as long as the last lookup kept the server busy, so biome
+        # lookups never take more than half of the Minecraft main thread
+        time.sleep(command_duration)
 
-        match = re.search(r"\((\d+) blocks away\)", output)
+        start = time.monotonic()
+        output = rcon.command(locate_biome_command(x, y, z, f"minecraft:{biome}"))
+        command_duration = time.monotonic() - start
+
+        match = BIOME_DISTANCE_PATTERN.search(output)
         if not match:
             print(f"Error: Could not parse output - {output}")
             continue
 
-        if match.group(1) == "0":
+        if int(match.group(1)) == 0:
             return biome
 
+    # Only the biome the spot is actually in is 0 blocks away. The nearest of
+    # the others says nothing about the spot, so don't guess.
+    return None
+
+
+SEED_PATTERN = re.compile(r"Seed: \[(-?\d+)\]")
+
+
+def world_seed(rcon):
+    output = rcon.command("seed")
+    match = SEED_PATTERN.search(output)
+    if not match:
+        raise Exception("Unexpected output from seed command: " + output)
+
+    return match.group(1)
+
+
+# Detected biomes and flavor text are kept between runs
+CACHE_FILENAME = "treasure_hunt_cache.json"
+# Bump whenever detect_biome or the flavor text prompt changes, so entries
+# computed by older code are thrown away
+CACHE_VERSION = 1
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {}
+
+    return cache["entries"]
+
+
+# Cron runs can overlap, so the cache is never held open. A new entry is merged
+# into a fresh read of the file, written to a temp file of this process's own
+# and swapped in whole.
+def store_cache_entry(cache_path, key, value):
+    cache = load_cache(cache_path)
+    cache[key] = value
+
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": CACHE_VERSION, "entries": cache}, f)
+    os.replace(tmp_path, cache_path)
+
+
+# Biomes are stored in 4x4x4 cells and vary with height, so spots in the same
+# 16 block chunk section almost always share a biome. The seed keeps entries
+# from a previous world from being used after a reset.
+def cached_detect_biome(cache_path, rcon, seed, x, y, z):
+    key = f"biome:{seed}:{x >> 4}:{y >> 4}:{z >> 4}"
+    biome = load_cache(cache_path).get(key)
+    if biome is None:
+        biome = detect_biome(rcon, x, y, z)
+        if biome is not None:
+            store_cache_entry(cache_path, key, biome)
+
+    return biome
+
 
 TREASURE_MAX_DIST = 5000
 TREASURE_DEAD_ZONE = 1000
@@ -233,21 +376,33 @@ def find_treasure_spot(rcon):
 
     try:
         if test_for_block(rcon, x, y, z, "minecraft:air"):
-            # Scan down
-            while test_for_block(rcon, x, y, z, "minecraft:air"):
-                y -= 1
-                if y < -TREASURE_MIN_HEIGHT:
-                    return None
-
-            y += 1
+            # Bisect down for the lowest y where the column up to the start is
+            # all air, i.e. just above the first block below the start
+            low, high = -TREASURE_MIN_HEIGHT, y
+            if count_non_air_blocks(rcon, x, low, high, z) == 0:
+                return None
+
+            while high - low > 1:
+                mid = (low + high) // 2
+                if count_non_air_blocks(rcon, x, mid, y, z) == 0:
+                    high = mid
+                else:
+                    low = mid
         else:
-            # Scan up
-            while not test_for_block(rcon, x, y, z, "minecraft:air"):
-                y += 1
-                if y > TREASURE_MAX_HEIGHT:
-                    return None
+            # Bisect up for the lowest y where the column from the start
+            # contains air, i.e. the first air block above the start
+            low, high = y, TREASURE_MAX_HEIGHT
+            if count_non_air_blocks(rcon, x, low, high, z) == high - low + 1:
+                return None
 
-        return x, y, z
+            while high - low > 1:
+                mid = (low + high) // 2
+                if count_non_air_blocks(rcon, x, y, mid, z) == mid - y + 1:
+                    low = mid
+                else:
+                    high = mid
+
+        return x, high, z
 
     except PositionNotLoaded:
         return None
@@ -296,17 +451,62 @@ def gpt_completion(prompt):
     return response["choices"][0]["message"]["content"]
 
 
+# Approximate coordinates mean identical prompts do come up between runs
+def cached_gpt_completion(cache_path, prompt):
+    key = "completion:" + hashlib.sha256(prompt.encode("utf8")).hexdigest()
+    completion = load_cache(cache_path).get(key)
+    if completion is None:
+        completion = gpt_completion(prompt)
+        store_cache_entry(cache_path, key, completion)
+
+    return completion
+
+
+PLAYER_LIST_PATTERN = re.compile(r"\d+ players online: (.*)")
+
+
 def list_players(rcon):
     response = rcon.command("list")
-    match = re.search(r"\d+ players online: (.*)", response)
+    match = PLAYER_LIST_PATTERN.search(response)
     if not match:
         return []
 
     return match.group(1).split(", ")
 
 
+# Compact JSON keeps RCON packets as small as possible
+def tellraw_json(tellraw_data):
+    if orjson is not None:
+        return orjson.dumps(tellraw_data).decode("utf8")
+
+    return json.dumps(tellraw_data, separators=(",", ":"))
+
+
+def announce_json(rcon, payload):
+    rcon.command(f"tellraw @a {payload}")
+
+
 def announce(rcon, tellraw_data):
-    rcon.command(f"tellraw @a {json.dumps(tellraw_data)}")
+    announce_json(rcon, tellraw_json(tellraw_data))
+
+
+TREASURE_HUNT_ANNOUNCEMENT = tellraw_json({
+    "text": "TREASURE HUNT!",
+    "color": "green",
+    "bold": True,
+})
+MOVE_QUICKLY_ANNOUNCEMENT = tellraw_json({
+    "text": "Move quickly! The treasure chest (and all of its contents) will disappear in 10 minutes!",
+    "color": "red",
+})
+TREASURE_EMPTIED_ANNOUNCEMENT = tellraw_json({
+    "text": "The treasure chest has been emptied!",
+    "color": "green",
+})
+TREASURE_VANISHED_ANNOUNCEMENT = tellraw_json({
+    "text": "The treasure chest vanishes back to the realm it came from!",
+    "color": "green",
+})
 
 
 def log(message, file, level="INFO"):
@@ -326,7 +526,7 @@ SKIP_ODDS = 48  # Higher number means less frequent treasure hunts
 WATER_LEVEL = 62
 
 
-def main(log_file):
+def main(log_file, cache_path):
     if random.randint(0, SKIP_ODDS) != 0:
         log("Skipping treasure hunt", log_file)
         return
@@ -337,6 +537,8 @@ def main(log_file):
             log("No online players, exiting", log_file)
             return
 
+        seed = world_seed(rcon)
+
         for _ in range(1000):
             location = find_treasure_spot(rcon)
             if location is None:
@@ -345,7 +547,7 @@ def main(log_file):
             x, y, z = location
             log(f"Found treasure spot at {x}, {y}, {z}", log_file)
 
-            biome = detect_biome(rcon, x, y, z)
+            biome = cached_detect_biome(cache_path, rcon, seed, x, y, z)
             if biome is None:
                 log("Could not detect biome, skipping", log_file)
                 continue
@@ -368,7 +570,7 @@ def main(log_file):
             z_approx = round(z / round_to) * round_to
 
             item = random.choice(MINECRAFT_TREASURES)
-            flavor_text = gpt_completion(textwrap.dedent(f"""
+            flavor_text = cached_gpt_completion(cache_path, textwrap.dedent(f"""
                 Please give me flavor text for a treasure hunt describing a
                 location where a chest is hidden in a Minecraft world.
 
@@ -387,11 +589,7 @@ def main(log_file):
 
             place_treasure(rcon, x, y, z, item)
             log(f"{item} placed at {x}, {y}, {z} in biome {biome}", log_file)
-            announce(rcon, {
-                "text": "TREASURE HUNT!",
-                "color": "green",
-                "bold": True,
-            })
+            announce_json(rcon, TREASURE_HUNT_ANNOUNCEMENT)
             announce(rcon, {
                 "text": flavor_text,
                 "color": "green",
@@ -402,10 +600,7 @@ def main(log_file):
 
             time.sleep(10)
 
-            announce(rcon, {
-                "text": "Move quickly! The treasure chest (and all of its contents) will disappear in 10 minutes!",
-                "color": "red",
-            })
+            announce_json(rcon, MOVE_QUICKLY_ANNOUNCEMENT)
 
             minute_tape = [None, None, None, None, None, 5, None, 3, 2, 1]
             for remaining_time_alert in minute_tape:
@@ -413,10 +608,7 @@ def main(log_file):
 
                 if treasure_gone(rcon, x, y, z):
                     log("Treasure was acquired!", log_file)
-                    announce(rcon, {
-                        "text": "The treasure chest has been emptied!",
-                        "color": "green",
-                    })
+                    announce_json(rcon, TREASURE_EMPTIED_ANNOUNCEMENT)
                     break
 
                 if remaining_time_alert is None:
@@ -435,10 +627,7 @@ def main(log_file):
 
                 if not treasure_gone(rcon, x, y, z):
                     # Only bother announcing the chest vanished if the treasure is still there
-                    announce(rcon, {
-                        "text": "The treasure chest vanishes back to the realm it came from!",
-                        "color": "green",
-                    })
+                    announce_json(rcon, TREASURE_VANISHED_ANNOUNCEMENT)
 
                 log("Treasure chest disappeared", log_file)
             else:
@@ -456,7 +645,7 @@ if __name__ == "__main__":
 
     with open(os.path.join(base_dir, "treasure_hunt.log"), "a") as log_file:
         try:
-            main(log_file)
+            main(log_file, os.path.join(base_dir, CACHE_FILENAME))
         except Exception as e:
             log(traceback.format_exception(e, limit=2), log_file, level="ERROR")
             raise e